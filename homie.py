@@ -8,9 +8,51 @@ __license__ = "MIT License"
 import logging
 logger = logging.getLogger(__name__)
 
+import socket
+from micropython import const
 from umqtt.simple import MQTTClient
 
 
+# The default MQTT quality of service for publishing.
+_QOS_AT_MOST_ONCE = const(0)
+
+# The version of the Homie convention implemented.
+_HOMIE_VERSION = "3.0.0"
+
+# The size of the broker socket's send buffer, so bursts of publishes don't block.
+_SEND_BUFFER_SIZE = const(4096)
+
+# The default MQTT keep alive period, in seconds.
+_DEFAULT_KEEPALIVE = const(60)
+
+
+def _set_nodelay(broker:MQTTClient, enabled:bool) -> None:
+	'''Toggles Nagle's algorithm on the broker's socket, if the port supports it.'''
+	if hasattr(socket, "TCP_NODELAY"):
+		broker.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+
+
+def _set_send_buffer(broker:MQTTClient, size:int) -> None:
+	'''Sets the size of the broker socket's send buffer, if the port supports it.'''
+	if hasattr(socket, "SO_SNDBUF"):
+		broker.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+
+
+class _Batch:
+	'''A context that queues a thing's publishes and flushes them back-to-back on exit.'''
+
+	def __init__(self, thing:"HomieThing") -> None:
+		self.__thing = thing
+
+	def __enter__(self) -> "_Batch":
+		self.__thing._start_batch()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> bool:
+		self.__thing._end_batch(exc_type is None)
+		return False
+
+
 class HomieThing:
 	'''A generic Homie entity.'''
 
@@ -18,6 +60,7 @@ class HomieThing:
 		self.__thing_id = thing_id
 		self.parent = parent
 		self.__broker = broker if broker else parent.__broker
+		self.__batch = None
 
 	@property
 	def thing_id(self) -> str:
@@ -31,15 +74,62 @@ class HomieThing:
 	def parent(self, parent:"HomieThing") -> None:
 		self.__parent = parent
 		self.__topic_name = f"{parent.__topic_name}/{self.__thing_id}" if parent else self.__thing_id
+		self.__attr_topics = {}
+
+	def _attr_topic(self, name:str) -> str:
+		'''Returns the topic of an attribute, building it only the first time.'''
+		topic = self.__attr_topics.get(name)
+		if topic is None:
+			topic = f"{self.__topic_name}/{name}"
+			self.__attr_topics[name] = topic
+		return topic
+
+	def set_attribute(self, name:str, value:str, qos:int=_QOS_AT_MOST_ONCE) -> None:
+		self.__publish(self._attr_topic(name), value, qos)
+
+	def set_value(self, value:str, qos:int=_QOS_AT_MOST_ONCE) -> None:
+		self.__publish(self.__topic_name, value, qos)
+
+	def batch(self) -> _Batch:
+		'''Returns a context within which publishes are queued and then flushed all at once.'''
+		return _Batch(self)
+
+	def _start_batch(self) -> None:
+		self.__batch = []
+		_set_nodelay(self.__broker, False)
+
+	def _end_batch(self, flush:bool) -> None:
+		batch = self.__batch
+		self.__batch = None
+		try:
+			if flush:
+				for topic, value, qos in batch:
+					self.__broker.publish(topic, value, retain=True, qos=qos)
+		finally:
+			# If the socket just failed, this might fail too and must not hide the original error.
+			try:
+				_set_nodelay(self.__broker, True)
+			except OSError as ose:
+				logger.debug(f"Unable to restore TCP_NODELAY: '{str(ose)}'.")
+
+	def _collect_attrs(self, out:list) -> list:
+		'''Appends this thing's (topic, value) attribute pairs, and its children's, to the list.'''
+		return out
+
+	def _attr(self, out:list, name:str, value:str) -> None:
+		out.append((self._attr_topic(name), value))
 
-	def set_attribute(self, name:str, value:str) -> None:
-		attribute_topic_name = f"{self.__topic_name}/{name}"
-		logger.debug(f"{attribute_topic_name} = {value}")
-		self.__broker.publish(attribute_topic_name, value, retain=True, qos=1)
+	def init(self) -> None:
+		'''https://homieiot.github.io/specification/#device-lifecycle'''
+		for topic, value in self._collect_attrs([]):
+			self.__publish(topic, value, _QOS_AT_MOST_ONCE)
 
-	def set_value(self, value:str) -> None:
-		logger.debug(f"{self.__topic_name} = {value}")
-		self.__broker.publish(self.__topic_name, value, retain=True, qos=1)
+	def __publish(self, topic:str, value:str, qos:int) -> None:
+		logger.debug(f"{topic} = {value}")
+		if self.__batch is not None:
+			self.__batch.append((topic, value, qos))
+		else:
+			self.__broker.publish(topic, value, retain=True, qos=qos)
 
 	def __str__(self) -> str:
 		return self.__thing_id
@@ -65,13 +155,13 @@ class Property(NamedHomieThing):
 		self.__data_type = data_type
 		self.__unit = unit
 
-	def init(self) -> None:
-		'''https://homieiot.github.io/specification/#device-lifecycle'''
-		self.set_attribute("$name", self.__name)
-		self.set_attribute("$datatype", self.__data_type)
-		self.set_attribute("$unit", self.__unit)
-		self.set_attribute("$retained", "true")
-		self.set_attribute("$settable", "false")
+	def _collect_attrs(self, out:list) -> list:
+		self._attr(out, "$name", self.name)
+		self._attr(out, "$datatype", self.__data_type)
+		self._attr(out, "$unit", self.__unit)
+		self._attr(out, "$retained", "true")
+		self._attr(out, "$settable", "false")
+		return out
 
 
 class Node(NamedHomieThing):
@@ -81,6 +171,7 @@ class Node(NamedHomieThing):
 		super().__init__(parent, thing_id, name)
 		self.__thing_type = thing_type
 		self.__properties = []
+		self.__joined_properties = None
 
 	@property
 	def type(self) -> str:
@@ -92,14 +183,17 @@ class Node(NamedHomieThing):
 
 	def add_property(self, prop:Property) -> None:
 		self.__properties.append(prop)
-
-	def init(self) -> None:
-		'''https://homieiot.github.io/specification/#device-lifecycle'''
-		self.set_attribute("$name", self.__name)
-		self.set_attribute("$type", self.__thing_type)
-		self.set_attribute("$properties", ",".join(map(str, self.__properties)))
+		self.__joined_properties = None
+
+	def _collect_attrs(self, out:list) -> list:
+		self._attr(out, "$name", self.name)
+		self._attr(out, "$type", self.__thing_type)
+		if self.__joined_properties is None:
+			self.__joined_properties = ",".join([prop.thing_id for prop in self.__properties])
+		self._attr(out, "$properties", self.__joined_properties)
 		for prop in self.__properties:
-			prop.init()
+			prop._collect_attrs(out)
+		return out
 
 
 class DeviceState:
@@ -119,6 +213,8 @@ class Device(NamedHomieThing):
 	def __init__(self, parent:HomieThing, thing_id:str, name:str, extensions:list[str]=None) -> None:
 		super().__init__(parent, thing_id, name)
 		self.__nodes = []
+		self.__joined_nodes = None
+		self.__state = None
 		self.__extensions = extensions if extensions else []
 
 	@property
@@ -127,6 +223,7 @@ class Device(NamedHomieThing):
 
 	def add_node(self, node:Node) -> None:
 		self.__nodes.append(node)
+		self.__joined_nodes = None
 
 	@property
 	def state(self) -> str:
@@ -134,6 +231,8 @@ class Device(NamedHomieThing):
 
 	@state.setter
 	def state(self, new_state:str) -> None:
+		if new_state == self.__state:
+			return
 		if new_state == DeviceState.INIT:
 			self.init()
 		else:
@@ -144,27 +243,50 @@ class Device(NamedHomieThing):
 	def extensions(self) -> list[str]:
 		return self.__extensions
 
-	def init(self) -> None:
-		'''https://homieiot.github.io/specification/#device-lifecycle'''
-		self.set_attribute("$state", DeviceState.INIT)
-		self.set_attribute("$homie", "3.0.0")
-		self.set_attribute("$name", self.__name)
-		self.set_attribute("$nodes", ",".join(map(str, self.__nodes)))
-		self.set_attribute("$extensions", ",".join(map(str, self.__extensions)))
+	def _collect_attrs(self, out:list) -> list:
+		self._attr(out, "$state", DeviceState.INIT)
+		self._attr(out, "$homie", _HOMIE_VERSION)
+		self._attr(out, "$name", self.name)
+		if self.__joined_nodes is None:
+			self.__joined_nodes = ",".join([node.thing_id for node in self.__nodes])
+		self._attr(out, "$nodes", self.__joined_nodes)
+		self._attr(out, "$extensions", ",".join(self.__extensions))
 		for node in self.__nodes:
-			node.init()
+			node._collect_attrs(out)
+		return out
 
 
 class Network(HomieThing):
 
-	def __init__(self, mqtt_client_id:str, broker_address:str, broker_port:int) -> None:
-		broker = MQTTClient(mqtt_client_id, broker_address, broker_port)
-		logger.debug(f"Connecting to message broker at '{broker_address}:{broker_port}'...")
-		broker.connect()
-		logger.info(f"Connected to message broker '{broker_address}:{broker_port}'.")
-		super().__init__(None, "homie", broker)
+	def __init__(self, mqtt_client_id:str, broker_address:str, broker_port:int, keepalive:int=None) -> None:
+		''':param keepalive: the MQTT keep alive period in seconds, so the broker drops half-open connections.'''
+		self.__keepalive = keepalive if keepalive is not None else _DEFAULT_KEEPALIVE
+		self.__client = MQTTClient(mqtt_client_id, broker_address, broker_port, keepalive=self.__keepalive)
+		self.__broker_address = broker_address
+		self.__broker_port = broker_port
+		super().__init__(None, "homie", self.__client)
 		self.__devices = []
 
+	@property
+	def keepalive(self) -> int:
+		return self.__keepalive
+
+	def connect(self) -> None:
+		'''(Re)connects to the message broker, dropping the previous connection if there was one.'''
+		client = self.__client
+		if client.sock:
+			client.sock.close()
+		logger.debug(f"Connecting to message broker at '{self.__broker_address}:{self.__broker_port}'...")
+		client.connect()
+		# MQTT frames here are small and latency matters more than segment count.
+		_set_nodelay(client, True)
+		_set_send_buffer(client, _SEND_BUFFER_SIZE)
+		logger.info(f"Connected to message broker '{self.__broker_address}:{self.__broker_port}'.")
+
+	def ping(self) -> None:
+		'''Pings the message broker, so that it keeps the connection alive.'''
+		self.__client.ping()
+
 	@property
 	def devices(self) -> list[Device]:
 		return self.__devices.copy()
@@ -9,109 +9,222 @@ import logging
 logger = logging.getLogger(__name__)
 
 import utime
-from machine import SoftUART, Pin
+import ustruct
+from micropython import const
+from machine import SoftUART, UART, Pin
 
 from system import System
 from homie import Network, Device, DeviceState, Node, Property
 
 
+# The number of samples in a sensor sampling cycle.
+_CYCLE_SAMPLES = const(7)
+
+# The amount of time after which a sampling cycle is considered finished.
+_CYCLE_TIMEOUT = const(4)
+
+# The type of the sensor's measurement response frames.
+_FRAME_TYPE = const(0x16)
+
+# The size of a sensor data frame, in octets.
+_FRAME_LEN = const(20)
+
+# The length of the data in a sensor data frame, as declared in its second octet.
+_DATA_LEN = const(17)
+
+# The first two octets of every sensor data frame: type and data length.
+_FRAME_HEADER = bytes((_FRAME_TYPE, _DATA_LEN))
+
+# A sensor data frame: header and 3 skipped octets, then PM2.5 (DF3, DF4) as big-endian.
+_FRAME_FORMAT = ">5xH"
+
+
 class __Publisher:
 	'''A publisher for the sensor values.'''
 
+	# The delay before the first reconnection retry, doubled on each failure.
+	__RECONNECT_MIN_DELAY = 1000
+
+	# The maximum delay between reconnection retries.
+	__RECONNECT_MAX_DELAY = 30000
+
+	# The maximum number of batches kept queued while publishing fails.
+	__MAX_QUEUED_BATCHES = 4
+
+
 	def __init__(self, system:System) -> None:
-		self.__device_id = system.device_id
-		self.__broker_address = system.config.get("mqtt.broker.host_address")
-		self.__broker_port = system.config.get("mqtt.broker.port", 1883)
-		self.__property = None
+		self.__batch_size = system.config.get("mqtt.batch_size", 1)
+		self.__samples = []
+		self.__last_sent = utime.ticks_ms()
+		self.__build_graph(system)
+		self.__connected = False
 		self.__connect()
 
 
+	def __build_graph(self, system:System) -> None:
+		'''Builds the Homie entities once, so that reconnections only have to re-publish them.'''
+		device_id = system.device_id
+		broker_address = system.config.get("mqtt.broker.host_address")
+		broker_port = system.config.get("mqtt.broker.port", 1883)
+		keepalive = system.config.get("mqtt.broker.keepalive")
+		self.__network = Network(device_id, broker_address, broker_port, keepalive)
+		self.__device = Device(self.__network, device_id.lower(), device_id)
+		node = Node(self.__device, "pm1006", "Cubic PM1006", "Air Quality Sensor")
+		# If we're batching, the samples are published together as JSON instead of one by one.
+		if self.__batch_size > 1:
+			self.__property = Property(node, "pm2_5_batch", "Particulate Matter Concentration (PM2.5) Samples", "string", "ug/m3")
+		else:
+			self.__property = Property(node, "pm2_5", "Particulate Matter Concentration (PM2.5)", "float", "ug/m3")
+		node.add_property(self.__property)
+		self.__device.add_node(node)
+
+
 	def __connect(self) -> None:
-		while not self.__property:
+		delay = self.__RECONNECT_MIN_DELAY
+		while not self.__connected:
 			try:
-				network = Network(self.__device_id, self.__broker_address, self.__broker_port)
-				device = Device(network, self.__device_id.lower(), self.__device_id)
-				node = Node(device, "pm1006", "Cubic PM1006", "Air Quality Sensor")
-				self.__property = Property(node, "pm2_5", "Particulate Matter Concentration (PM2.5)", "float", "ug/m3")
-				node.add_property(self.__property)
-				device.add_node(node)
-				device.state = DeviceState.INIT
-				device.state = DeviceState.READY
+				self.__network.connect()
+				with self.__device.batch():
+					self.__device.state = DeviceState.INIT
+					self.__device.state = DeviceState.READY
+				self.__connected = True
+				self.__last_sent = utime.ticks_ms()
 			except Exception as e:
-				self.__property = None
-				logger.warning(f"Error connecting to message broker: '{str(e)}'.")
-				utime.sleep_ms(3000)
+				logger.warning(f"Error connecting to message broker: '{str(e)}', retrying in {delay} ms.")
+				utime.sleep_ms(delay)
+				delay = min(delay * 2, self.__RECONNECT_MAX_DELAY)
 
 
-	def publish(self, message:str) -> bool:
+	def keep_alive(self) -> None:
+		'''Pings the message broker if nothing was sent for half the keep alive period, since
+		umqtt.simple doesn't, so that the broker doesn't drop an idle connection.
+		'''
+		keepalive = self.__network.keepalive
+		if not keepalive or not self.__connected:
+			return
+		if utime.ticks_diff(utime.ticks_ms(), self.__last_sent) < keepalive * 500:
+			return
+		try:
+			self.__network.ping()
+			self.__last_sent = utime.ticks_ms()
+		except Exception as e:
+			logger.warning(f"Error pinging message broker: '{str(e)}'.")
+			self.__connected = False
+
+
+	def publish(self, value:float, datetime:str) -> bool:
+		'''Publishes a sensor value or, if batching, queues it until there are batch_size values.
+		:param value: the PM2.5 value.
+		:param datetime: the value's time in ISO 8601 format.
+		:returns: True if the value (or its batch) was successfully published, otherwise False.
+		'''
+		if self.__batch_size <= 1:
+			return self.__publish(str(value))
+		samples = self.__samples
+		samples.append((datetime, value))
+		# If publishing keeps failing, the oldest samples are dropped so the queue doesn't grow forever.
+		if len(samples) > self.__batch_size * self.__MAX_QUEUED_BATCHES:
+			del samples[0]
+		if len(samples) < self.__batch_size:
+			logger.debug(f"Queued {value} ug/m3 at {datetime} ({len(samples)}/{self.__batch_size}).")
+			return False
+		import json
+		# Samples are only discarded once published, so a failed batch is retried with the next one.
+		if self.__publish(json.dumps({"samples": [{"timestamp": t, "pm2_5": v} for t, v in samples]})):
+			samples.clear()
+			return True
+		return False
+
+
+	def __publish(self, message:str) -> bool:
 		''':returns: True if the message was successfully publised, otherwise False.'''
-		# If we're "connected" to the message broker...
-		if self.__property:
+		# If we're connected to the message broker...
+		if self.__connected:
 			try:
-				self.__property.set_value(message)
+				self.__property.set_value(message, qos=1)
+				self.__last_sent = utime.ticks_ms()
 				return True
 			except Exception as e:
 				logger.warning(f"Error publishing to message broker: '{str(e)}'.")
-				self.__property = None
-		# ... otherwise, we try to establish a new connection.
-		if not self.__property:
-			self.__connect()
+				self.__connected = False
+		# ... otherwise, we try to reconnect and publish again.
+		self.__connect()
+		try:
+			self.__property.set_value(message, qos=1)
+			self.__last_sent = utime.ticks_ms()
+			return True
+		except Exception as e:
+			logger.warning(f"Error publishing to message broker: '{str(e)}'.")
+			self.__connected = False
 		return False
 
 
 class __VindriktningReader:
 	'''A client for the VINDRIKTNING sensor.'''
 
-	# The number of samples in a sensor sampling cycle.
-	__CYCLE_SAMPLES = 7
-
-	# The amount of time after which a sampling cycle is considered finished.
-	__CYCLE_TIMEOUT = 4
-
-
 	def __init__(self, system:System, publisher:__Publisher) -> None:
 		self.__system = system
 		self.__publisher = publisher
 
-		# https://github.com/micropython/micropython/pull/7784
 		tx_pin = system.config.get("uart.tx_pin")
 		self.__rx_pin = system.config.get("uart.rx_pin")
-		self.__uart = SoftUART(Pin(tx_pin), Pin(self.__rx_pin), baudrate=9600, timeout=0)
+		uart_id = system.config.get("uart.id")
+		self.__rx_idle = False
+		self.__irq_driven = uart_id is not None and hasattr(UART, "IRQ_RXIDLE")
+		if uart_id is not None and not self.__irq_driven:
+			logger.warning(f"UART {uart_id} configured but UART.IRQ_RXIDLE isn't supported, using SoftUART instead.")
+		# If a hardware UART is configured, we only read once the line goes idle after a frame...
+		if self.__irq_driven:
+			self.__uart = UART(uart_id, baudrate=9600, tx=tx_pin, rx=self.__rx_pin, timeout=0)
+			self.__uart.irq(handler=self.__on_rx_idle, trigger=UART.IRQ_RXIDLE)
+		# ... otherwise, we poll the software one.
+		else:
+			# https://github.com/micropython/micropython/pull/7784
+			self.__uart = SoftUART(Pin(tx_pin), Pin(self.__rx_pin), baudrate=9600, timeout=0)
 
 		self.__stop_requested = False
-		self.__buffer = []
+		self.__clear_samples()
 
 
 	def start(self) -> None:
 		logger.info(f"Sensor reader started on pin {self.__rx_pin}.")
 		while not self.__stop_requested:
 			try:
-				data = self.__uart.read()
-				if data:
-					self.__handle_sensor_data(data)
+				if not self.__irq_driven or self.__rx_idle:
+					self.__rx_idle = False
+					data = self.__uart.read()
+					if data:
+						self.__handle_sensor_data(data)
 			except Exception as e:
 				logger.warning(f"Error handling sensor data: '{str(e)}'.")
 			try:
 				self.__publish_if_cycle_ended()
 			except Exception as e:
 				logger.warning(f"Error publishing sensor data: '{str(e)}'.")
+			try:
+				self.__publisher.keep_alive()
+			except Exception as e:
+				logger.warning(f"Error keeping the message broker connection alive: '{str(e)}'.")
 
 			utime.sleep_ms(500)
 		logger.info("Sensor reader stopped.")
 
 
+	def __on_rx_idle(self, uart:UART) -> None:
+		'''Flags that the sensor finished sending a burst of data.'''
+		self.__rx_idle = True
+
+
 	def __handle_sensor_data(self, data:bytes) -> None:
 		'''Handles data events from the sensor.'''
 		timestamp = self.__system.time.time()
 		try:
 			value = self.__decode_sensor_data(data)
 			if value >=0 and value <= 1000:
-				sample = {
-					"timestamp": timestamp,
-					"pm2_5": value
-				}
-				self.__buffer.append(sample)
-				logger.debug(f"Read data: {sample}.")
+				self.__pm2_5_sum += value
+				self.__nsamples += 1
+				self.__last_sample_time = timestamp
+				logger.debug(f"Read data: {value} ug/m3 at {timestamp}.")
 		except ValueError as ve:
 			logger.warning(f"Error decoding sensor data: '{str(ve)}'.")
 
@@ -129,45 +242,48 @@ class __VindriktningReader:
 		# Note: PM2.5(μg/m³)= DF3*256+DF4"
 		# Additional comments: the second octet is the length of the data.
 		# Other DFs are missing from the example above :), poor documentation.
-		nframes = int(len(data) / 20)
+		# The last octet is the checksum: all 20 octets of a frame add up to 0 (mod 256).
+		frames = memoryview(data)
+		nframes = len(frames) // _FRAME_LEN
+		if not nframes or len(frames) % _FRAME_LEN:
+			raise ValueError(f"Invalid data size, expecting a multiple of {_FRAME_LEN} bytes, received {len(frames)} bytes")
 		sum_values = 0
-		for i in range(nframes):
-			offset = i * 20
-			frame_type = data[offset]
-			if frame_type != 0x16:
-				raise ValueError(f"Invalid data frame type, expecting 0x16, received {hex(frame_type)}")
-			data_length = data[offset + 1]
-			if data_length != 17:
-				raise ValueError(f"Invalid data frame length, expecting 17 bytes, received {data_length} bytes")
-			df3 = data[offset + 5]
-			df4 = data[offset + 6]
-			value = df3 * 256 + df4
+		for offset in range(0, nframes * _FRAME_LEN, _FRAME_LEN):
+			if frames[offset:offset + 2] != _FRAME_HEADER:
+				raise ValueError(f"Invalid data frame header, expecting {_FRAME_HEADER}, received {bytes(frames[offset:offset + 2])}")
+			value = ustruct.unpack_from(_FRAME_FORMAT, frames, offset)[0]
+			checksum = sum(frames[offset:offset + _FRAME_LEN]) & 0xFF
+			if checksum:
+				raise ValueError(f"Invalid data frame checksum, frame adds up to {hex(checksum)} instead of 0x0")
 			sum_values += value
 
-		return int(sum_values / nframes)
+		return sum_values // nframes
 
 
 	def __publish_if_cycle_ended(self) -> None:
 		'''Publishes the sampled values if the sensor sampling cycled has ended. A cycle has ended when
 		CYCLE_SAMPLES have been read or no more samples were read after CYCLE_TIMEOUT seconds.
 		'''
-		buffer = self.__buffer
-		if buffer:
-			nsamples = len(buffer)
-			last_sample_time = buffer[-1]["timestamp"]
+		nsamples = self.__nsamples
+		if nsamples:
+			last_sample_time = self.__last_sample_time
 			current_time = self.__system.time.time()
-			timedout = (current_time - last_sample_time) > self.__CYCLE_TIMEOUT
-			if nsamples >= self.__CYCLE_SAMPLES or timedout:
-				value_sum = 0
-				for sample in buffer:
-					value_sum += sample["pm2_5"]
-				value = round(value_sum / nsamples, 1)
+			timedout = (current_time - last_sample_time) > _CYCLE_TIMEOUT
+			if nsamples >= _CYCLE_SAMPLES or timedout:
+				value = round(self.__pm2_5_sum / nsamples, 1)
 				datetime = self.__system.time.iso_time(last_sample_time)
 				try:
-					if self.__publisher.publish(str(value)):
+					if self.__publisher.publish(value, datetime):
 						logger.info(f"Published {value} ug/m3 at {datetime}.")
 				finally:
-					buffer.clear()
+					self.__clear_samples()
+
+
+	def __clear_samples(self) -> None:
+		'''Discards the samples of the current cycle.'''
+		self.__pm2_5_sum = 0
+		self.__nsamples = 0
+		self.__last_sample_time = 0
 
 
 	def stop(self):
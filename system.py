@@ -10,11 +10,13 @@ logger = logging.getLogger(__name__)
 
 import network
 import utime
-import ntptime
-import json
 from network import WLAN
 
 
+# The ISO 8601 format for date/times in UTC.
+_ISO_FORMAT = "%04d-%02d-%02d %02d:%02d:%02d+00:00"
+
+
 class __Config:
 	"""A wrapper to manage loading and accessing configuration."""
 
@@ -28,6 +30,7 @@ class __Config:
 		except OSError as ose:
 			logger.error(f"Unable to open configuration file '{self.__CONFIG_FILE_PATH}': {str(ose)}")
 		if config_file:
+			import json
 			with config_file:
 				self.__config = json.load(config_file)
 			logger.info("Configuration loaded.")
@@ -61,6 +64,10 @@ class __Time:
 	# The number of retries to sync with the NTP server.
 	__NTP_RETRIES = 5
 
+	# The delay before the first NTP retry, doubled on each failure. As sync() blocks the sensor
+	# reading loop, the retries add up to 250+500+1000+2000 = 3750 ms at most.
+	__NTP_RETRY_DELAY = 250
+
 
 	def __init__(self, config:__Config):
 		self.__NTP_SYNC_PERIOD = config.get("network.ntp.sync_period")
@@ -71,14 +78,18 @@ class __Time:
 		'''Sets the RTC with date/time from an NTP server.
 		:returns: the time retrieved from the NTP server, or the current RTC time if it failed.
 		'''
-		for _ in range(self.__NTP_RETRIES):
+		import ntptime
+		delay = self.__NTP_RETRY_DELAY
+		for attempt in range(1, self.__NTP_RETRIES + 1):
 			try:
 				ntptime.settime()
 				logger.info(f"RTC time set to '{self.iso_time()}'.")
 				return utime.time()
 			except Exception as e:
 				logger.info(f"Error retrieving NTP time: {str(e)}.")
-				utime.sleep_ms(1000)
+				if attempt < self.__NTP_RETRIES:
+					utime.sleep_ms(delay)
+					delay *= 2
 		logger.warning("Unable to get NTP time, RTC will have an arbitrary reference.")
 		return utime.time()
 
@@ -92,20 +103,26 @@ class __Time:
 			self.__last_ntp_sync = self.sync()
 			return self.__last_ntp_sync
 		else:
-			return utime.time()
+			return current_time
 
 
 	def iso_time(self, datetime:int=None) -> str:
 		'''Returns the time in ISO 8601 format. If no argument is passed, uses the RTC time.
 		:param datetime: the number of seconds since the Epoch (2000-01-01 00:00:00 UTC).
 		'''
-		tokens = utime.localtime(datetime)
-		return "%04d-%02d-%02d %02d:%02d:%02d+00:00"%(tokens[0:6])
+		year, month, day, hour, minute, second, _, _ = utime.localtime(datetime)
+		return _ISO_FORMAT % (year, month, day, hour, minute, second)
 
 
 class __WLAN:
 	'''A wrapper for network.WLAN.'''
 
+	# The delay before the first connection check, doubled while not connected.
+	__CONNECT_MIN_DELAY = 1000
+
+	# The maximum delay between connection checks.
+	__CONNECT_MAX_DELAY = 30000
+
 	def __init__(self, if_id:int, ssid:str, key:str) -> None:
 		''':param wlan_type: see the 'network' module.'''
 		self.__if_id = if_id
@@ -136,14 +153,13 @@ class __WLAN:
 			logger.info(f"AP running with ESSID '{self.__ssid}'.")
 
 		elif self.__if_id == network.STA_IF:
-			connected = False
+			delay = self.__CONNECT_MIN_DELAY
 			self.__wlan_if.connect(self.__ssid, self.__key)
-			while not connected:
-				utime.sleep_ms(3000)
-				if self.__wlan_if.isconnected():
-					connected = True
-				else:
-					logger.debug(f"Connecting to '{self.__ssid}'...")
+			utime.sleep_ms(delay)
+			while not self.__wlan_if.isconnected():
+				logger.debug(f"Connecting to '{self.__ssid}'...")
+				delay = min(delay * 2, self.__CONNECT_MAX_DELAY)
+				utime.sleep_ms(delay)
 			ifcfg = self.__wlan_if.ifconfig()
 			logger.info(f"Connected to '{self.__ssid}': IP={ifcfg[0]} GW={ifcfg[2]} DNS={ifcfg[3]}")
 